@@ -0,0 +1,198 @@
+import os, io, re, hashlib, importlib.metadata, tempfile, usaddress, pandas as pd, numpy as np
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.csv as pacsv, pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sqlalchemy.types import Integer, SmallInteger
+
+# Helpers shared by the state ETLs (etl_fl.py, etl_tx.py): address cleaning, aggregation and the bulk loader.
+
+# CONFIGURATION
+RAW_CHUNK_SIZE = int(os.environ.get('RAW_CHUNK_SIZE', 50000))  # Rows per CSV write batch feeding the COPY
+COPY_SPOOL_SIZE = 512 << 20  # Bytes of COPY payload buffered in RAM before spilling to a temp file
+PARSE_CHUNK_SIZE = 500  # Minimum distinct addresses per usaddress task sent to a worker process
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 0))  # usaddress worker processes; 0 = every CPU this process may use
+EXTRACT_CACHE_DIR = os.environ.get('EXTRACT_CACHE_DIR', '.extract_cache')  # Parquet copies of the last download
+EXTRACT_BLOCK_SIZE = 8 << 20  # Bytes per Arrow CSV parse block (one block per parser thread)
+
+# Compiled once at import; reused by every vectorized pass
+ADDRESS_SCRUB_RE = re.compile(r'[^A-Z0-9 \-\#]')
+RESIDENTIAL_RE = re.compile(r'\b(?:APT|UNIT|TRLR|LOT)\b')  # Whole words only: no hits inside CAPTAIN / UNITED / LOTUS
+ADDRESS_PARTS = ('AddressNumber', 'StreetName', 'StreetNamePostType', 'OccupancyType', 'OccupancyIdentifier')  # usaddress labels kept, in order
+
+# Fast path for plain "NUMBER [DIR] NAME SUFFIX [UNIT ID]" lines; anything else goes to usaddress.
+# Groups mirror ADDRESS_PARTS (a leading directional is matched but dropped, as in the usaddress join).
+# It must produce what clean_address_ai would (tests/test_address_fast_path.py checks both paths agree), so:
+# - BLDG / RM / FL units are left to usaddress: it tags BLDG as a Subaddress (dropped by the join) and RM / FL by context
+# - a street name never contains a type, unit, directional, route prefix or bare number word: usaddress reads those
+#   by context ("10 N ST" -> "10 ST" but "100 E ST" -> "100 E ST"; "123 US HWY" -> "123"), and so are spelled-out
+#   directions ("123 EAST PKWY N" -> "123 PKWY") and CAMINO, a Spanish street type it drops ("7 CAMINO REAL RD" -> "7 REAL RD")
+# - no directional after the street type: usaddress keeps it as an OccupancyIdentifier in some contexts
+#   ("123 MAIN HWY E" -> "123 MAIN HWY E") and drops it in others
+# Known divergence: usaddress is a statistical tagger and occasionally mis-tags a plain line the pattern accepts
+# ("4500 BEACH ROAD" -> "4500", "10 E 1ST ROAD" -> "10"; ~0.1% of fuzzed matches). There the fast path keeps the street.
+STREET_SUFFIXES = 'ST|STREET|AVE|AVENUE|RD|ROAD|DR|DRIVE|BLVD|LN|LANE|CT|COURT|PL|PLACE|WAY|PKWY|HWY|CIR|TER|TRL|SQ|CSWY'
+UNIT_TYPES = 'STE|SUITE|APT|UNIT'
+DIRECTIONS = 'N|S|E|W|NE|NW|SE|SW'
+RESERVED_WORDS = (rf'{STREET_SUFFIXES}|{UNIT_TYPES}|{DIRECTIONS}|BLDG|RM|FL|HIGHWAY|US|STATE|COUNTY|FM|SR|CR|RR|ROUTE|BOX|CAMINO|'
+                  r'NORTH|SOUTH|EAST|WEST|NORTHEAST|NORTHWEST|SOUTHEAST|SOUTHWEST')
+NAME_WORD = rf'(?!(?:{RESERVED_WORDS})\b)(?!\d+\b)[A-Z0-9]+'
+SIMPLE_ADDRESS_RE = re.compile(
+    rf'^(?P<num>\d+[A-Z]?) (?:(?:{DIRECTIONS}) )?(?P<name>{NAME_WORD}(?: {NAME_WORD})*?) (?P<suffix>{STREET_SUFFIXES})'
+    rf'(?: (?P<unit>{UNIT_TYPES}) (?P<uid>[A-Z0-9-]+))?\Z')  # Anchored: vectorized extract must match whole strings
+
+# Persisted tags are only valid for the inputs that produced them: the kept labels, the usaddress model, and the
+# scrub / fast-path patterns that decide which strings reach usaddress. Stamped into the cache file, checked on read.
+TAG_CACHE_VERSION = hashlib.sha1(repr((ADDRESS_PARTS, importlib.metadata.version('usaddress'), ADDRESS_SCRUB_RE.pattern,
+                                       SIMPLE_ADDRESS_RE.pattern)).encode()).hexdigest()
+
+def read_ragged_csv(source, column_names, include_columns=None, encoding='latin1'):
+    """
+    All-string Arrow parse of a CSV body (latin1 unless told otherwise), as tolerant of ragged rows as pandas: short rows
+    are padded with nulls and kept, rows with too many fields are skipped. include_columns keeps only those columns.
+    The skip count is stamped into the schema metadata ('skipped_rows') so it survives the Parquet cache; read it back
+    with skipped_rows().
+    """
+    short, long = [], []
+    def ragged(row):  # Only called for rows whose field count is off
+        (short if row.actual_columns < row.expected_columns else long).append(row)
+        return 'skip'
+    convert_options = pacsv.ConvertOptions(column_types={c: pa.string() for c in column_names}, strings_can_be_null=True,
+                                           include_columns=include_columns or [])
+    table = pacsv.read_csv(source,
+                           read_options=pacsv.ReadOptions(column_names=column_names, encoding=encoding, block_size=EXTRACT_BLOCK_SIZE),
+                           parse_options=pacsv.ParseOptions(invalid_row_handler=ragged), convert_options=convert_options)
+    if short:
+        # Trailing empty fields, re-parsed with the same null handling as the main body (appended after it)
+        padded = '\n'.join(row.text + ',' * (row.expected_columns - row.actual_columns) for row in short)
+        table = pa.concat_tables([table, pacsv.read_csv(io.BytesIO(padded.encode()), read_options=pacsv.ReadOptions(column_names=column_names),
+                                                        convert_options=convert_options)])
+    return table.replace_schema_metadata({'skipped_rows': str(len(long))})
+
+def skipped_rows(tables):
+    return sum(int((t.schema.metadata or {}).get(b'skipped_rows', 0)) for t in tables)  # 0 for Parquet cached before the stamp
+
+def copy_frame(df, table_name, engine, dtype=None):
+    """
+    Replaces `table_name` with the rows of df (a DataFrame or an Arrow table), bulk loaded with a single COPY FROM STDIN
+    into a staging table that is swapped in only once fully loaded. Arrow's CSV writer spools the rows (RAM up to
+    COPY_SPOOL_SIZE, then a temp file), so rows never pass through Python tuples and the server sees one statement.
+    """
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False)
+    staging = f'{table_name}_staging'
+    columns = ', '.join(f'"{c}"' for c in table.column_names)
+    with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE) as buf:
+        pacsv.write_csv(table, buf, write_options=pacsv.WriteOptions(include_header=False, batch_size=RAW_CHUNK_SIZE))
+        buf.seek(0)
+        # One pooled checkout for the whole load: the DDL is compiled against it (the same CREATE TABLE to_sql would
+        # emit, without its reflection queries), then the statements run on its DBAPI connection
+        with engine.connect() as sa_conn:
+            ddl = pd.io.sql.get_schema(table.schema.empty_table().to_pandas(), staging, con=sa_conn, dtype=dtype)
+            conn = sa_conn.connection
+            with conn.cursor() as cur:
+                # A failed load (network error, count out of range for its column) leaves only the staging table behind:
+                # the live table keeps the previous run's rows, and the next run drops the leftover staging table
+                cur.execute(f'DROP TABLE IF EXISTS {staging}')
+                cur.execute(ddl)
+                conn.commit()
+                cur.copy_expert(f'COPY {staging} ({columns}) FROM STDIN WITH CSV', buf)
+                conn.commit()
+                # Swap in one transaction: readers see the old table or the new one, never a missing or empty one
+                cur.execute(f'DROP TABLE IF EXISTS {table_name}')
+                cur.execute(f'ALTER TABLE {staging} RENAME TO {table_name}')
+            conn.commit()
+
+def clean_address_ai(clean_val):
+    try:
+        parsed, valid = usaddress.tag(clean_val)
+        joined = " ".join(filter(None, map(parsed.get, ADDRESS_PARTS)))  # One pass: lookup, skip missing, join
+        if joined: return joined
+    except usaddress.RepeatedLabelError:  # Ambiguous parse: keep the scrubbed string. Anything else is a real bug.
+        pass
+    return clean_val
+
+def fast_clean(addresses):
+    """
+    clean_address_ai for the plain addresses SIMPLE_ADDRESS_RE accepts, as one vectorized extract; NaN for the rest.
+    """
+    parts = addresses.str.extract(SIMPLE_ADDRESS_RE)
+    cleaned = parts['num'].str.cat([parts[g] for g in ('name', 'suffix', 'unit', 'uid')], sep=' ', na_rep='')
+    return cleaned.str.split().str.join(' ').where(parts['num'].notna())  # Drop the gaps left by empty groups
+
+def clean_addresses(raw, tag_cache_path):
+    """
+    Vectorized pre-clean of a raw address Series (Too Short / PO Box filters, character scrub).
+    Every step runs once per distinct raw string and is gathered back by factorize code; returns a Categorical, filtered rows as NaN.
+    """
+    codes, uniq = pd.factorize(raw)  # One hash pass over the rows; code -1 marks nulls
+    # Trim + uppercase as Arrow kernels, then Python str from here on, once per distinct value (re patterns below)
+    upper = pd.Series(pc.utf8_upper(pc.utf8_trim_whitespace(pa.array(uniq, type=pa.string()))).to_pandas(), dtype=object)
+    keep = (upper.str.len() >= 3) & ~upper.str.startswith('PO BOX')
+    scrubbed = upper[keep].str.replace(ADDRESS_SCRUB_RE, '', regex=True)
+    # Spelling variants often scrub to the same string: tag each distinct scrubbed address once
+    distinct = pd.Series(scrubbed.unique())
+    # Fast path as one vectorized extract in this process; only the misses are shipped to usaddress workers
+    cleaned = fast_clean(distinct)
+    slow = distinct[cleaned.isna()]
+    # usaddress results from the last run (the cache dir is restored between CI runs): only new residuals get tagged
+    if os.path.exists(tag_cache_path):
+        cached = pq.read_table(tag_cache_path)
+        if (cached.schema.metadata or {}).get(b'tag_version') == TAG_CACHE_VERSION.encode():
+            known = cached.to_pandas().set_index('address')['clean']
+            cleaned[slow.index] = known.reindex(slow.values).values
+        else:
+            print("   ♻️ Address tag cache built by another parser version, re-tagging every residual")
+    todo = slow[cleaned[slow.index].isna()]
+    if len(todo) <= PARSE_CHUNK_SIZE:
+        cleaned[todo.index] = [clean_address_ai(a) for a in todo]  # Fewer residuals than one task: cheaper than spawning workers
+    else:
+        # usaddress is pure-Python CRF tagging (GIL-bound), so fan it out across cores.
+        # Spawned (not forked) workers: the raw COPY thread is live while the pool starts.
+        # Size the pool to the CPUs this process may actually run on (CI containers pin fewer than cpu_count()),
+        # or to PARSE_WORKERS when another ETL shares the machine (the workflow runs FL and TX side by side)
+        workers = PARSE_WORKERS or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            # ~4 tasks per worker: few pickling round trips, still enough slack to even out slow chunks
+            chunk = max(PARSE_CHUNK_SIZE, len(todo) // (workers * 4))
+            cleaned[todo.index] = list(pool.map(clean_address_ai, todo.tolist(), chunksize=chunk))
+    # Rewritten from this run's residuals only, so addresses that left the extracts age out
+    os.makedirs(os.path.dirname(tag_cache_path) or '.', exist_ok=True)
+    tags = pa.table({'address': pa.array(slow.values, type=pa.string()), 'clean': pa.array(cleaned[slow.index].values, type=pa.string())})
+    pq.write_table(tags.replace_schema_metadata({'tag_version': TAG_CACHE_VERSION}), tag_cache_path, compression='zstd')
+    tagged = dict(zip(distinct, cleaned))
+    per_uniq = scrubbed.map(tagged).reindex(upper.index).to_numpy(dtype=object)  # NaN where filtered out
+    # Categorical straight from the codes (no second hash pass over the rows): downstream keys hash ints, not strings
+    cat_codes, categories = pd.factorize(per_uniq)  # Distinct raw strings that clean to the same address share a category
+    return pd.Series(pd.Categorical.from_codes(np.append(cat_codes, -1)[codes], categories), index=raw.index)  # -1 -> NaN
+
+def sum_by(keys, values, columns):
+    """
+    Per-key sums of a (rows x columns) count matrix on Arrow's multithreaded hash aggregation:
+    groupby(keys, sort=False).sum() without ever writing the counts into DataFrame columns.
+    Rows with a null key are dropped, as pandas does.
+    """
+    names = list(keys.columns)
+    valid = ~keys.isna().to_numpy().any(axis=1)
+    table = pa.Table.from_pandas(keys[valid], preserve_index=False)
+    for i, c in enumerate(columns):
+        table = table.append_column(c, pa.array(values[valid, i]))
+    summed = table.group_by(names).aggregate([(c, 'sum') for c in columns]).to_pandas()
+    summed = summed.rename(columns={f"{c}_sum": c for c in columns})[names + columns]
+    summed[columns] = summed[columns].apply(pd.to_numeric, downcast='integer')  # Arrow widens int8 sums to int64: smallest fitting int
+    return summed
+
+def count_types(grouped, columns):
+    """
+    Column types for the per-type counts: INT2 when every count fits, INT4 otherwise. One count past 32,767
+    (a big chain address) would otherwise fail the whole gold COPY and silently keep yesterday's table.
+    """
+    return {c: SmallInteger if grouped[c].max() <= np.iinfo(np.int16).max else Integer for c in columns}
+
+def determine_type(grouped):
+    multi = grouped['total_licenses'].to_numpy() > 1
+    # Keyword scan only where it decides the outcome: multi-license addresses are Commercial regardless
+    residential = np.zeros(len(grouped), dtype=bool)
+    # RE2 kernel over the Arrow buffer: no per-row Python re.search call as with object-dtype str.contains
+    addresses = pa.array(grouped.loc[~multi, 'address_clean'], type=pa.string())
+    matched = pc.match_substring_regex(addresses, RESIDENTIAL_RE.pattern)
+    residential[~multi] = pc.fill_null(matched, False).to_numpy(zero_copy_only=False)
+    return np.where(residential, 'Residential', 'Commercial')  # residential is only ever set on single-license rows
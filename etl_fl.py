@@ -1,106 +1,165 @@
-import os, sys, pandas as pd, requests, io, re, certifi, usaddress, urllib3
+import os, sys, csv, json, pandas as pd, numpy as np, requests, io, re, certifi, urllib3
+import pyarrow as pa, pyarrow.parquet as pq
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from sqlalchemy import create_engine
 from sqlalchemy.types import Integer, Text
+from concurrent.futures import ThreadPoolExecutor
+from etl_common import (EXTRACT_CACHE_DIR, EXTRACT_BLOCK_SIZE, copy_frame, clean_addresses, sum_by, determine_type,
+                        read_ragged_csv, skipped_rows, count_types)
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Shared HTTP session: both extracts come from the same host over one kept-alive connection pool;
+# connection errors and gateway 5xx are retried with backoff when the stream is opened
+session = requests.Session()
+session.mount('https://', HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1.5, status_forcelist=[502, 503, 504])))
+
 # CONFIGURATION
 FL_COSMO_URL = "https://www2.myfloridalicense.com/sto/file_download/extracts/COSMETOLOGYLICENSE_1.csv"
 FL_BARBER_URL = "https://www2.myfloridalicense.com/sto/file_download/extracts/lic03bb.csv"
 RAW_TABLE = 'address_insights_fl_raw'
+DUMP_RAW = os.environ.get('DUMP_RAW') == '1'  # Opt-in copy of the untransformed extracts to RAW_TABLE (nothing downstream reads it)
 GOLD_TABLE = 'address_insights_fl_gold'
+TAG_CACHE_PATH = os.path.join(EXTRACT_CACHE_DIR, 'fl_address_tags.parquet')  # usaddress output per residual address, kept across runs
+
+# Positional columns the transform reads (the extracts have no header row) -> working names
+FL_COLUMNS = {'1': 'type', '5': 'a1', '6': 'a2', '8': 'city', '9': 'state', '10': 'zip', '12': 'license',
+              '13': 'primary_status', '14': 'secondary_status', 'source_file': 'source_file'}
+
+SCHOOL_TYPE_RE = re.compile('PROV|PVDR|CRSE|SPRV|HIVC')
+
+# License type -> indicator column (school codes are matched by SCHOOL_TYPE_RE)
+TYPE_FLAGS = {
+    'BB': 'is_barber', 'BR': 'is_barber', 'BA': 'is_barber',
+    'CL': 'is_cosmo', 'FV': 'is_cosmo', 'FB': 'is_cosmo', 'FS': 'is_cosmo',
+    'CE': 'is_salon', 'MCS': 'is_salon', 'BS': 'is_barbershop', 'OR': 'is_owner'
+}
+FLAG_COLUMNS = ['is_barber', 'is_cosmo', 'is_salon', 'is_barbershop', 'is_owner', 'is_school']
+COUNT_COLUMNS = ['count_barber', 'count_cosmetologist', 'count_salon', 'count_barbershop', 'count_owner', 'count_school']  # Gold names, same order
 
 try:
-    db_string = os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://")
-    db_string = f"{db_string}{'&' if '?' in db_string else '?'}sslrootcert={certifi.where()}"
+    url = urlsplit(os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://"))
+    query = dict(parse_qsl(url.query)); query.setdefault('sslrootcert', certifi.where())  # Keep a caller-supplied CA
+    db_string = urlunsplit(url._replace(query=urlencode(query)))
     engine = create_engine(db_string)
 except KeyError:
     print("❌ ERROR: DB_CONNECTION_STRING missing."); sys.exit(1)
 
-def clean_address_ai(raw_addr):
-    if not isinstance(raw_addr, str) or len(raw_addr.strip()) < 3: return None, "Too Short"
-    if raw_addr.upper().startswith('PO BOX'): return None, "PO Box Filter"
-    
-    clean_val = re.sub(r'[^A-Z0-9 \-\#]', '', raw_addr.upper().strip())
-    try:
-        parsed, valid = usaddress.tag(clean_val)
-        parts = [parsed.get(k) for k in ['AddressNumber', 'StreetName', 'StreetNamePostType', 'OccupancyType', 'OccupancyIdentifier'] if parsed.get(k)]
-        if parts: return " ".join(parts), None
-    except:
-        pass
-    return clean_val, None
-
-def determine_type(row):
-    if row['total_licenses'] > 1: return 'Commercial'
-    addr = str(row['address_clean'])
-    if any(x in addr for x in ['APT', 'UNIT', 'TRLR', 'LOT']): return 'Residential'
-    return 'Commercial'
+def type_flag(code):
+    return TYPE_FLAGS.get(code, 'is_school' if SCHOOL_TYPE_RE.search(code) else None)
+
+def fetch_extract(url, name):
+    """
+    Downloads an extract as an Arrow table, reusing the cached Parquet copy when the
+    server reports the file unchanged (ETag / Last-Modified conditional GET).
+    """
+    parquet_path = os.path.join(EXTRACT_CACHE_DIR, f"{name}.parquet")
+    meta_path = f"{parquet_path}.json"
+    headers = {}
+    if os.path.exists(parquet_path) and os.path.exists(meta_path):
+        with open(meta_path) as f: validators = json.load(f)
+        if 'ETag' in validators: headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators: headers['If-Modified-Since'] = validators['Last-Modified']
+
+    with session.get(url, stream=True, verify=False, timeout=60, headers=headers) as r:
+        if r.status_code == 304:
+            print(f"   ♻️ {name} unchanged since last run, using cached Parquet")
+            return pq.read_table(parquet_path)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Parsed straight off the socket: the body is never held in memory as one bytes object.
+        # Every column pinned to string (no type inference, ZIPs and license numbers keep their leading zeros).
+        # No header row: the first record, peeked without consuming it, fixes the column count.
+        # Short rows are padded and kept, over-long ones skipped and counted (pandas' header=None / on_bad_lines='skip')
+        body = io.BufferedReader(r.raw, buffer_size=EXTRACT_BLOCK_SIZE)
+        width = len(next(csv.reader([body.peek().split(b'\n', 1)[0].rstrip(b'\r').decode('latin1')])))
+        table = read_ragged_csv(body, [str(i) for i in range(width)])
+        if skipped_rows([table]): print(f"   ⚠️ {name}: skipped {skipped_rows([table])} rows with too many fields")
+        validators = {k: r.headers[k] for k in ('ETag', 'Last-Modified') if k in r.headers}
+
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    pq.write_table(table, parquet_path, compression='zstd')
+    with open(meta_path, 'w') as f: json.dump(validators, f)
+    return table
 
 def get_florida_data():
     print("🌴 FETCHING: Florida Data...")
-    dfs = []
-    def process(url, name):
+    def fetch(source):
+        url, name = source
         try:
-            r = requests.get(url, verify=False, timeout=60)
-            df = pd.read_csv(io.BytesIO(r.content), encoding='latin1', on_bad_lines='skip', header=None)
-            df['source_file'] = name
-            return df
+            table = fetch_extract(url, name)
+            # Positional string columns; the cast only touches Parquet cached before the reader pinned the schema
+            metadata = table.schema.metadata  # Skip count: rename_columns drops schema metadata
+            table = table.rename_columns([str(i) for i in range(table.num_columns)])
+            table = table.cast(pa.schema([(c, pa.string()) for c in table.column_names], metadata=metadata))
+            return table.append_column('source_file', pa.repeat(name, table.num_rows))
         except Exception as e:
-            print(f"   ⚠️ Error {name}: {e}"); return pd.DataFrame()
-    dfs.append(process(FL_COSMO_URL, "Cosmetology"))
-    dfs.append(process(FL_BARBER_URL, "Barbers"))
-    return pd.concat(dfs, ignore_index=True)
+            print(f"   ⚠️ Error {name}: {e}")
+    # Both extracts download (and parse, GIL released) concurrently; results keep the listed order
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tables = [t for t in pool.map(fetch, ((FL_COSMO_URL, "Cosmetology"), (FL_BARBER_URL, "Barbers"))) if t is not None]
+    if not tables: return pa.table({})
+    return pa.concat_tables(tables, promote_options='default').replace_schema_metadata({'skipped_rows': str(skipped_rows(tables))})
 
 def main():
     print("🚀 STARTING: Florida ETL Pipeline")
-    raw_df = get_florida_data()
-    if raw_df.empty: sys.exit(1)
+    raw_table = get_florida_data()
+    if raw_table.num_rows == 0: sys.exit(1)
 
-    raw_df.to_sql(RAW_TABLE, engine, if_exists='replace', index=False)
-    initial_count = len(raw_df)
+    # Raw dump (DUMP_RAW=1 only) runs on a background thread straight from the Arrow table, overlapping the (CPU-bound) transform
+    raw_loader = ThreadPoolExecutor(max_workers=1)
+    raw_load = raw_loader.submit(copy_frame, raw_table, RAW_TABLE, engine) if DUMP_RAW else None
+    initial_count = raw_table.num_rows
 
-    df = raw_df.copy()
-    valid_status = df[df[13].isin(['C', 'P']) & (df[14] == 'A')]
-    status_loss = initial_count - len(valid_status)
-    
-    df_step2 = valid_status.copy()
-    df_step2 = df_step2.rename(columns={1: 'type', 5: 'a1', 6: 'a2', 8: 'city', 9: 'state', 10: 'zip'})
-    df_step2['raw_address'] = (df_step2['a1'].fillna('').astype(str) + " " + df_step2['a2'].fillna('').astype(str)).str.strip()
+    # Only the columns the transform reads leave Arrow; status filter + projection in one pass
+    raw_df = raw_table.select(list(FL_COLUMNS)).to_pandas(types_mapper=pd.ArrowDtype).rename(columns=FL_COLUMNS)
+    status_mask = (raw_df['primary_status'].isin(['C', 'P']) & (raw_df['secondary_status'] == 'A')).fillna(False)
+    df_step2 = raw_df.loc[status_mask, ['type', 'a1', 'a2', 'city', 'state', 'zip', 'license', 'source_file']]
+    status_loss = initial_count - len(df_step2)
+    del raw_df
+
+    # A licensee listed twice in one extract would be counted twice: keep one row per (file, license, street line)
+    dupes = df_step2.duplicated(subset=['source_file', 'license', 'a1']) & df_step2['license'].notna()
+    df_step2 = df_step2[~dupes].copy()
+    dup_loss = int(dupes.sum())
+    # a1/a2 are still Arrow strings: the concat and strip run as Arrow kernels, no per-row Python str boxing
+    df_step2['raw_address'] = (df_step2['a1'].fillna('') + " " + df_step2['a2'].fillna('')).str.strip()
     
-    cleaned_results = df_step2['raw_address'].apply(clean_address_ai)
-    df_step2['address_clean'] = cleaned_results.apply(lambda x: x[0] if x else None)
+    df_step2['address_clean'] = clean_addresses(df_step2['raw_address'], TAG_CACHE_PATH)
     
-    # FIXED: Added .copy() here to prevent repeated SettingWithCopyWarning
-    df_step3 = df_step2.dropna(subset=['address_clean']).copy()
+    # One boolean mask; only the columns categorization and aggregation read are copied
+    has_address = df_step2['address_clean'].notna().to_numpy()
+    df_step3 = df_step2.loc[has_address, ['address_clean', 'city', 'state', 'zip', 'type']]
     address_loss = len(df_step2) - len(df_step3)
 
-    # Categorization
-    df_step3['is_barber'] = df_step3['type'].str.fullmatch('BB|BR|BA', case=True).fillna(False).astype(int)
-    df_step3['is_cosmo'] = df_step3['type'].str.fullmatch('CL|FV|FB|FS', case=True).fillna(False).astype(int)
-    df_step3['is_salon'] = df_step3['type'].str.fullmatch('CE|MCS', case=True).fillna(False).astype(int)
-    df_step3['is_barbershop'] = df_step3['type'].str.fullmatch('BS', case=True).fillna(False).astype(int)
-    df_step3['is_owner'] = df_step3['type'].str.fullmatch('OR', case=True).fillna(False).astype(int)
-    df_step3['is_school'] = df_step3['type'].str.contains('PROV|PVDR|CRSE|SPRV|HIVC', case=True).fillna(False).astype(int)
+    # Categorization: one dict lookup per distinct license type (no per-row regex sweeps), one-hot once,
+    # then gather the rows by category code
+    types = df_step3['type'].astype('category').cat
+    per_code = pd.get_dummies(pd.Series(types.categories.map(type_flag)), dtype='int8').reindex(columns=FLAG_COLUMNS, fill_value=0)
+    flag_table = np.vstack([per_code.to_numpy(), np.zeros(len(FLAG_COLUMNS), dtype='int8')])  # Last row serves null codes (-1)
+    flags = flag_table[types.codes.to_numpy()]
     
-    grouped = df_step3.groupby(['address_clean', 'city', 'state', 'zip']).agg({
-        'is_barber': 'sum', 'is_cosmo': 'sum', 'is_salon': 'sum', 
-        'is_barbershop': 'sum', 'is_owner': 'sum', 'is_school': 'sum'
-    }).reset_index().rename(columns={
-        'city': 'city_clean', 'zip': 'zip_clean',
-        'is_barber': 'count_barber', 'is_cosmo': 'count_cosmetologist',
-        'is_salon': 'count_salon', 'is_barbershop': 'count_barbershop', 
-        'is_owner': 'count_owner', 'is_school': 'count_school'
+    # Matrix columns follow FLAG_COLUMNS, so they are summed straight into their Gold names
+    grouped = sum_by(df_step3[['address_clean', 'city', 'state', 'zip']], flags, COUNT_COLUMNS).rename(columns={
+        'city': 'city_clean', 'zip': 'zip_clean'
     })
-    grouped['total_licenses'] = grouped[['count_barber', 'count_cosmetologist', 'count_salon', 'count_barbershop']].sum(axis=1)
-    grouped['address_type'] = grouped.apply(determine_type, axis=1)
+    grouped['total_licenses'] = grouped[['count_barber', 'count_cosmetologist', 'count_salon', 'count_barbershop']].to_numpy().sum(axis=1)  # One count per license row: a plain sum, no per-group distinct
+    grouped['address_type'] = determine_type(grouped)
 
-    grouped.to_sql(GOLD_TABLE, engine, if_exists='replace', index=False, 
-                   dtype={'address_clean': Text, 'city_clean': Text, 'total_licenses': Integer})
+    # Gold COPY runs on its own connection while the raw dump may still be streaming
+    copy_frame(grouped, GOLD_TABLE, engine, dtype={'address_clean': Text, 'city_clean': Text, 'total_licenses': Integer,
+                                          **count_types(grouped, COUNT_COLUMNS)})  # Per-type counts as INT2 when they fit
+    if raw_load: raw_load.result()
+    raw_loader.shutdown()
 
     print(f"\n--- FLORIDA AUDIT REPORT ---")
     # FIXED: Added f"" wrapper below
     print(f"Initial Raw Records:    {initial_count}")
+    print(f"Skipped (Malformed):  {skipped_rows([raw_table])}")
     print(f"Removed (Inactive/S): {status_loss}")
+    print(f"Removed (Duplicate):  {dup_loss}")
     print(f"Removed (PO Box/Bad): {address_loss}")
     print(f"Final Gold Locations: {len(grouped)}")
     print(f"---------------------------\n")
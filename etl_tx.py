@@ -1,10 +1,21 @@
-import os, sys, pandas as pd, requests, re, certifi, usaddress, numpy as np, io, urllib3
+import os, sys, csv, json, pandas as pd, requests, re, certifi, numpy as np, io, threading, urllib3
+import pyarrow as pa, pyarrow.parquet as pq
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from sqlalchemy import create_engine
 from sqlalchemy.types import Integer, Text
+from concurrent.futures import ThreadPoolExecutor
+from etl_common import (EXTRACT_CACHE_DIR, EXTRACT_BLOCK_SIZE, copy_frame, clean_addresses, sum_by, determine_type,
+                        read_ragged_csv, skipped_rows, count_types)
 
 # SUPPRESS WARNINGS
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Shared HTTP session: connection errors and gateway 5xx are retried with backoff when the stream is opened
+session = requests.Session()
+session.mount('https://', HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1.5, status_forcelist=[502, 503, 504])))
+
 # CONFIGURATION
 TDLR_URLS = {
     'barber_schools': "https://www.tdlr.texas.gov/dbproduction2/Ltbarscl.csv",
@@ -17,8 +28,27 @@ TDLR_URLS = {
 # Texas Comptroller - Active Sales Tax Permit Holders (Statewide, Free)
 COMPTROLLER_URL = "https://data.texas.gov/api/views/jrea-zgmq/rows.csv?accessType=DOWNLOAD"
 
+# Only the columns the transform reads are carried past the raw dump
+TX_COLUMNS = ['BUSINESS NAME', 'NAME', 'LICENSE TYPE', 'LICENSE SUBTYPE', 'source_file',
+              'BUSINESS ADDRESS-LINE1', 'BUSINESS ADDRESS-LINE2', 'BUSINESS CITY, STATE ZIP',
+              'MAILING ADDRESS LINE1', 'MAILING ADDRESS LINE2', 'MAILING ADDRESS CITY, STATE ZIP']
+TX_CATEGORY_COLUMNS = ['LICENSE TYPE', 'LICENSE SUBTYPE', 'source_file']
+SHOP_SOURCES = ['establishments', 'barber_schools', 'cosmo_schools']  # Extracts whose rows are places, not people
+COMPTROLLER_COLUMNS = ['Taxpayer Name', 'Outlet Address', 'Outlet City', 'Outlet Zip Code']
+
 RAW_TABLE = "address_insights_tx_raw"
+DUMP_RAW = os.environ.get('DUMP_RAW') == '1'  # Opt-in copy of the untransformed extracts to RAW_TABLE (nothing downstream reads it)
 GOLD_TABLE = "address_insights_tx_gold"
+TAG_CACHE_PATH = os.path.join(EXTRACT_CACHE_DIR, 'tx_address_tags.parquet')  # usaddress output per residual address, kept across runs
+
+# Compiled once at import; reused by every vectorized pass
+CITY_ZIP_RE = re.compile(r'(.*?)\s*,?\s*TX\s*(\d{5})')
+BARBER_TYPE_RE = re.compile('BARBER')
+COSMO_TYPE_RE = re.compile('COSMO')
+SALON_TYPE_RE = re.compile('COSMO|SALON|ESTAB')
+SHOP_TYPE_RE = re.compile('BARBER|SHOP')
+BOOTH_TYPE_RE = re.compile('BOOTH')
+MATCH_KEY_TABLE = str.maketrans('', '', ',')  # Characters dropped from owner names before the Comptroller match
 
 SUBTYPES = {
     'barbers': ['BA', 'BT', 'TE', 'BR'],
@@ -26,35 +56,91 @@ SUBTYPES = {
     'places':  ['CS', 'MS', 'FS', 'HS', 'FM', 'WS', 'BS', 'DS'],
     'schools': ['BC', 'VS', 'JC', 'PS']
 }
+SUBTYPE_GROUPS = {code: group for group, codes in SUBTYPES.items() for code in codes}  # Inverse map: one lookup per subtype
+COUNT_COLUMNS = ['count_barber', 'count_cosmetologist', 'count_salon', 'count_barbershop', 'count_school', 'count_booth']
 
 try:
-    base_conn = os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://")
-    sep = '&' if '?' in base_conn else '?'
-    db_string = f"{base_conn}{sep}sslrootcert={certifi.where()}"
+    base_conn = urlsplit(os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://"))
+    params = dict(parse_qsl(base_conn.query)); params.setdefault('sslrootcert', certifi.where())  # Keep a caller-supplied CA
+    db_string = urlunsplit(base_conn._replace(query=urlencode(params)))
     engine = create_engine(db_string)
 except KeyError:
     print("❌ ERROR: DB_CONNECTION_STRING missing."); sys.exit(1)
 
-def clean_address_ai(raw_addr):
-    if not isinstance(raw_addr, str) or len(raw_addr.strip()) < 3: return None
-    if raw_addr.upper().startswith('PO BOX'): return None
-    clean_val = re.sub(r'[^A-Z0-9 \-\#]', '', raw_addr.upper().strip())
-    try:
-        parsed, valid = usaddress.tag(clean_val)
-        parts = [parsed.get(k) for k in ['AddressNumber', 'StreetName', 'StreetNamePostType', 'OccupancyType', 'OccupancyIdentifier'] if parsed.get(k)]
-        if parts: return " ".join(parts)
-    except: pass
-    return clean_val
-
-def determine_type(row):
-    if row['total_licenses'] > 1: return 'Commercial'
-    addr = str(row['address_clean'])
-    if any(x in addr for x in ['APT', 'UNIT', 'TRLR', 'LOT']): return 'Residential'
-    return 'Commercial'
-
-def enrich_from_comptroller(df_target):
+def split_city_zip(loc):
+    """
+    Parses 'CITY, TX 12345' once per distinct location string and maps the result back onto the rows.
+    """
+    uniq = loc.dropna().unique()
+    parsed = pd.Series(uniq, index=uniq).str.extract(CITY_ZIP_RE)
+    parsed = pd.DataFrame({'city': parsed[0].str.strip(), 'zip': parsed[1].str[:5]})
+    return parsed.reindex(loc.values).set_axis(loc.index)
+
+def fetch_extract(url, name):
+    """
+    Downloads a TDLR file as an all-string Arrow table, reusing the cached Parquet copy when the
+    server reports the file unchanged (ETag / Last-Modified conditional GET).
+    """
+    parquet_path = os.path.join(EXTRACT_CACHE_DIR, f"tx_{name}.parquet")
+    meta_path = f"{parquet_path}.json"
+    headers = {}
+    if os.path.exists(parquet_path) and os.path.exists(meta_path):
+        with open(meta_path) as f: validators = json.load(f)
+        if 'ETag' in validators: headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators: headers['If-Modified-Since'] = validators['Last-Modified']
+
+    with session.get(url, stream=True, timeout=180, verify=False, headers=headers) as r:
+        if r.status_code == 304:
+            print(f"   ♻️ {name} unchanged since last run, using cached Parquet")
+            return pq.read_table(parquet_path)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Multithreaded Arrow parse with every column pinned to string (same as dtype=str: ZIPs keep leading zeros).
+        # Large buffered reads off the socket: the parser fills whole blocks while the rest is still downloading.
+        # A ragged row no longer costs the whole file: short rows are padded (as pandas did), over-long ones skipped and counted
+        body = io.BufferedReader(r.raw, buffer_size=EXTRACT_BLOCK_SIZE)
+        header = next(csv.reader([body.readline().decode('latin1')]))
+        table = read_ragged_csv(body, header)
+        if skipped_rows([table]): print(f"   ⚠️ {name}: skipped {skipped_rows([table])} rows with too many fields")
+        validators = {k: r.headers[k] for k in ('ETag', 'Last-Modified') if k in r.headers}
+
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    pq.write_table(table, parquet_path, compression='zstd')
+    with open(meta_path, 'w') as f: json.dump(validators, f)
+    return table
+
+class CancellableBody(io.RawIOBase):
+    """
+    Response body that stops at the next block read (EXTRACT_BLOCK_SIZE) once `cancel` is set: a prefetch nobody is waiting for
+    would otherwise keep downloading (and hold interpreter exit, which joins executor threads) until done.
+    """
+    def __init__(self, raw, cancel): self.raw, self.cancel = raw, cancel
+    def readable(self): return True
+    def readinto(self, b):
+        if self.cancel.is_set(): raise ConnectionAbortedError("Comptroller download no longer needed")
+        return self.raw.readinto(b)
+
+def fetch_comptroller(cancel):
     """
-    Downloads statewide Active Sales Tax Permit Holders to match Practitioner Names to Physical Locations.
+    Downloads statewide Active Sales Tax Permit Holders (taxpayer name + outlet address columns only).
+    Abandoned (the future raises) once `cancel` is set.
+    """
+    print("   ⬇️ Downloading Texas Active Sales Tax Permit Holders (Statewide)...")
+    # Stream download straight into the parser to avoid buffering the full body
+    with session.get(COMPTROLLER_URL, stream=True, verify=False, timeout=600) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Read only necessary columns: Taxpayer Name, Outlet Address info (multithreaded Arrow parse, all strings,
+        # empty fields -> null; short rows padded and kept, over-long ones skipped and counted, as pandas did)
+        body = io.BufferedReader(CancellableBody(r.raw, cancel), buffer_size=EXTRACT_BLOCK_SIZE)
+        header = next(csv.reader([body.readline().decode('utf-8-sig')]))  # Strip a BOM, as pandas does
+        table = read_ragged_csv(body, header, include_columns=COMPTROLLER_COLUMNS, encoding='utf8')
+    if skipped_rows([table]): print(f"   ⚠️ Comptroller: skipped {skipped_rows([table])} rows with too many fields")
+    return table.to_pandas()
+
+def enrich_from_comptroller(df_target, tax_download):
+    """
+    Matches Practitioner Names to Physical Locations using the (prefetched) statewide permit holders.
     """
     print("\n🔎 STARTING: Statewide Comptroller Enrichment (Sales Tax Permits)")
     missing_mask = df_target['address_clean'].isnull()
@@ -65,46 +151,34 @@ def enrich_from_comptroller(df_target):
         return df_target
 
     try:
-        print("   ⬇️ Downloading Texas Active Sales Tax Permit Holders (Statewide)...")
-        # Stream download to avoid memory issues
-        r = requests.get(COMPTROLLER_URL, stream=True, verify=False, timeout=600)
-        
-        # Read only necessary columns: Taxpayer Name, Outlet Address info
-        df_tax = pd.read_csv(io.BytesIO(r.content), 
-                             usecols=['Taxpayer Name', 'Outlet Address', 'Outlet City', 'Outlet Zip Code'],
-                             dtype=str, on_bad_lines='skip')
-        
+        df_tax = tax_download.result()
         print(f"   ... Loaded {len(df_tax)} Taxpayer Records. Indexing...")
         
-        # Normalize for matching (Remove commas to match Taxpayer Name format)
-        df_tax['match_key'] = df_tax['Taxpayer Name'].str.strip().str.upper()
-        df_target['match_key'] = df_target['NAME'].astype(str).str.replace(',', '', regex=False).str.strip().str.upper()
+        # Normalize for matching (Remove commas to match Taxpayer Name format). Each distinct name is normalized
+        # once and gathered back by factorize code; on our side only rows still missing an address get a key.
+        codes, names = pd.factorize(df_tax['Taxpayer Name'])
+        df_tax['match_key'] = np.append(pd.Series(names, dtype=object).str.strip().str.upper().to_numpy(), None)[codes]
+        codes, names = pd.factorize(df_target['NAME'].where(missing_mask))
+        target_keys = np.append(pd.Series(names, dtype=object).str.translate(MATCH_KEY_TABLE).str.strip().str.upper().to_numpy(), None)[codes]
         
-        # Deduplicate to create unique lookup
-        tax_unique = df_tax.drop_duplicates(subset=['match_key'])
-        tax_lookup = tax_unique.set_index('match_key')[['Outlet Address', 'Outlet City', 'Outlet Zip Code']].to_dict('index')
-        
-        def apply_tax_match(row):
-            if pd.isnull(row['address_clean']) and pd.notnull(row['match_key']):
-                match = tax_lookup.get(row['match_key'])
-                if match:
-                    raw_addr = str(match['Outlet Address'])
-                    if 'PO BOX' not in raw_addr.upper():
-                        return raw_addr, match['Outlet City'], match['Outlet Zip Code']
-            return None, None, None
-
-        enriched = df_target.apply(apply_tax_match, axis=1, result_type='expand')
+        # Deduplicate to create unique lookup; PO Box outlets (and blank ones) are no better than no match
+        tax_unique = df_tax.dropna(subset=['match_key']).drop_duplicates(subset=['match_key'])
+        tax_lookup = tax_unique.set_index('match_key')[['Outlet Address', 'Outlet City', 'Outlet Zip Code']]
+        tax_lookup = tax_lookup[~tax_lookup['Outlet Address'].str.upper().str.contains('PO BOX', regex=False, na=True)]
+
+        # Hash-join rows still missing an address to permits by name (one reindex, no per-row apply)
+        enriched = tax_lookup.reindex(target_keys).set_axis(df_target.index)
         
         # Update Main DataFrame
-        updates = enriched[0].notnull()
-        df_target.loc[updates, 'address_clean'] = enriched.loc[updates, 0]
+        updates = enriched['Outlet Address'].notnull()
+        df_target.loc[updates, 'address_clean'] = enriched.loc[updates, 'Outlet Address']
         
         # Update fallback columns
         if 'enriched_city' not in df_target.columns: df_target['enriched_city'] = np.nan
         if 'enriched_zip' not in df_target.columns: df_target['enriched_zip'] = np.nan
         
-        df_target.loc[updates, 'enriched_city'] = df_target.loc[updates, 'enriched_city'].fillna(enriched.loc[updates, 1])
-        df_target.loc[updates, 'enriched_zip'] = df_target.loc[updates, 'enriched_zip'].fillna(enriched.loc[updates, 2])
+        df_target.loc[updates, 'enriched_city'] = df_target.loc[updates, 'enriched_city'].fillna(enriched.loc[updates, 'Outlet City'])
+        df_target.loc[updates, 'enriched_zip'] = df_target.loc[updates, 'enriched_zip'].fillna(enriched.loc[updates, 'Outlet Zip Code'])
         
         print(f"   ✅ COMPTROLLER MATCHES FOUND: {updates.sum()}")
         
@@ -117,106 +191,138 @@ def enrich_from_comptroller(df_target):
 
 def main():
     print("🚀 STARTING: Texas Direct CSV ETL Pipeline (Internal + Comptroller)")
-    all_dfs = []
-    
-    # 1. EXTRACT
-    for name, url in TDLR_URLS.items():
-        try:
-            print(f"   📥 Downloading: {name}...")
-            r = requests.get(url, timeout=180, verify=False)
-            df = pd.read_csv(io.BytesIO(r.content), encoding='latin1', low_memory=False)
-            df['source_file'] = name
-            all_dfs.append(df)
-        except Exception as e:
-            print(f"   ⚠️ Warning {name}: {e}")
-
-    if not all_dfs: sys.exit(1)
-    raw_df = pd.concat(all_dfs, ignore_index=True)
-    raw_df.astype(str).to_sql(RAW_TABLE, engine, if_exists='replace', index=False)
-    initial_count = len(raw_df)
-
-    # 2. TRANSFORM
-    df = raw_df.copy().replace('', np.nan)
-    
-    df['a1'] = df['BUSINESS ADDRESS-LINE1'].fillna(df['MAILING ADDRESS LINE1'])
-    df['a2'] = df['BUSINESS ADDRESS-LINE2'].fillna(df['MAILING ADDRESS LINE2'])
-    df['loc_combined'] = df['BUSINESS CITY, STATE ZIP'].fillna(df['MAILING ADDRESS CITY, STATE ZIP'])
-    df['raw_address'] = (df['a1'].fillna('').astype(str) + " " + df['a2'].fillna('').astype(str)).str.strip()
-    df['address_clean'] = df['raw_address'].apply(clean_address_ai)
-
-    missing_before = df['address_clean'].isnull().sum()
-    print(f"\n📊 AUDIT: Missing Addresses Baseline: {missing_before}")
-
-    # 3. INTERNAL SKIP TRACE
-    print("\n🔎 STARTING: Internal Skip Trace")
-    shops_df = df[df['source_file'].isin(['establishments', 'barber_schools', 'cosmo_schools'])].dropna(subset=['address_clean'])
-    loc_p = shops_df['loc_combined'].str.extract(r'(.*?)\s*,?\s*TX\s*(\d{5})')
-    shops_df['city_match'] = loc_p[0].str.strip()
-    shops_df['zip_match'] = loc_p[1].str[:5]
+    # The statewide permit file is the biggest download: start it now so it overlaps the TDLR fetch and transform
+    prefetch, cancel = ThreadPoolExecutor(max_workers=1), threading.Event()
+    tax_download = prefetch.submit(fetch_comptroller, cancel)
+    try:
+        def fetch(name, url):
+            try:
+                print(f"   📥 Downloading: {name}...")
+                table = fetch_extract(url, name)
+                return table.append_column('source_file', pa.repeat(name, table.num_rows))
+            except Exception as e:
+                print(f"   ⚠️ Warning {name}: {e}")
+
+        # 1. EXTRACT (files download concurrently; results keep TDLR_URLS order)
+        with ThreadPoolExecutor(max_workers=len(TDLR_URLS)) as ex:
+            all_tables = [t for t in ex.map(fetch, TDLR_URLS.keys(), TDLR_URLS.values()) if t is not None]
+
+        if not all_tables: sys.exit(1)
+        # Raw layer stays in Arrow: files with different columns are null-filled, like pd.concat
+        raw_table = pa.concat_tables(all_tables, promote_options='default')
+        # Raw dump (DUMP_RAW=1 only) runs on a background thread so the DB upload overlaps the (CPU-bound) transform
+        raw_loader = ThreadPoolExecutor(max_workers=1)
+        raw_load = raw_loader.submit(copy_frame, raw_table, RAW_TABLE, engine) if DUMP_RAW else None
+        initial_count = raw_table.num_rows
+
+        # 2. TRANSFORM (only the columns the transform uses become Python objects)
+        # Low-cardinality columns are dictionary-encoded in Arrow and arrive as categoricals (no Python str per row):
+        # small integer codes per row, and .str/.isin run once per category. An empty type/subtype matches no
+        # category, exactly like a missing one, so only the free-text columns need the '' -> NaN pass.
+        projected = raw_table.select(TX_COLUMNS)
+        for c in TX_CATEGORY_COLUMNS:
+            projected = projected.set_column(projected.schema.get_field_index(c), c, projected.column(c).dictionary_encode())
+        df = projected.to_pandas()
+        text_columns = [c for c in TX_COLUMNS if c not in TX_CATEGORY_COLUMNS]
+        df[text_columns] = df[text_columns].replace('', np.nan)
     
-    shops_unique = shops_df.drop_duplicates(subset=['BUSINESS NAME'])
-    shop_lookup = shops_unique.set_index('BUSINESS NAME')[['address_clean', 'city_match', 'zip_match']].to_dict('index')
-
-    def enrich_internal(row):
-        if pd.notnull(row['address_clean']): return row['address_clean'], None, None
-        match = shop_lookup.get(row['BUSINESS NAME'])
-        if match: return match['address_clean'], match['city_match'], match['zip_match']
-        return None, None, None
-
-    enriched = df.apply(enrich_internal, axis=1, result_type='expand')
-    updates = enriched[0].notnull() & df['address_clean'].isnull()
-    df.loc[updates, 'address_clean'] = enriched.loc[updates, 0]
-    df['enriched_city'] = enriched[1]
-    df['enriched_zip'] = enriched[2]
+        df['a1'] = df['BUSINESS ADDRESS-LINE1'].fillna(df['MAILING ADDRESS LINE1'])
+        df['a2'] = df['BUSINESS ADDRESS-LINE2'].fillna(df['MAILING ADDRESS LINE2'])
+        df['loc_combined'] = df['BUSINESS CITY, STATE ZIP'].fillna(df['MAILING ADDRESS CITY, STATE ZIP'])
+        df['raw_address'] = (df['a1'].fillna('') + " " + df['a2'].fillna('')).str.strip()  # Already str: no astype re-boxing
+        df['address_clean'] = clean_addresses(df['raw_address'], TAG_CACHE_PATH).astype(object)  # Plain strings: the skip traces below fill it in place
+        # Parse every 'CITY, TX ZIP' once; the skip trace and final cleaning both align on df's index
+        loc_parsed = split_city_zip(df['loc_combined'])
+
+        missing_before = df['address_clean'].isnull().sum()
+        print(f"\n📊 AUDIT: Missing Addresses Baseline: {missing_before}")
+
+        # 3. INTERNAL SKIP TRACE
+        print("\n🔎 STARTING: Internal Skip Trace")
+        shops_df = df[df['source_file'].isin(SHOP_SOURCES)].dropna(subset=['address_clean'])
+        shops_df['city_match'] = loc_parsed['city']
+        shops_df['zip_match'] = loc_parsed['zip']
     
-    print(f"   ✅ Internal Matches Found: {updates.sum()}")
-
-    # 4. COMPTROLLER ENRICHMENT
-    df = enrich_from_comptroller(df)
-
-    # 5. FINAL CLEANING
-    df_step2 = df.dropna(subset=['address_clean']).copy()
-    address_loss = initial_count - len(df_step2)
-
-    loc_parsed = df_step2['loc_combined'].str.extract(r'(.*?)\s*,?\s*TX\s*(\d{5})')
-    if 'enriched_city' in df_step2.columns:
-        df_step2['city_clean'] = loc_parsed[0].str.strip().fillna(df_step2['enriched_city'])
-        df_step2['zip_clean'] = loc_parsed[1].str[:5].fillna(df_step2['enriched_zip'])
-    else:
-        df_step2['city_clean'] = loc_parsed[0].str.strip()
-        df_step2['zip_clean'] = loc_parsed[1].str[:5]
+        shops_unique = shops_df.dropna(subset=['BUSINESS NAME']).drop_duplicates(subset=['BUSINESS NAME'])
+        shop_lookup = shops_unique.set_index('BUSINESS NAME')[['address_clean', 'city_match', 'zip_match']]
+
+        # Hash-join rows still missing an address to shops by name (one reindex, no per-row apply)
+        matched = shop_lookup.reindex(df['BUSINESS NAME'].where(df['address_clean'].isnull()).values).set_axis(df.index)
+        updates = matched['address_clean'].notnull()
+        df.loc[updates, 'address_clean'] = matched.loc[updates, 'address_clean']
+        df['enriched_city'] = matched['city_match']
+        df['enriched_zip'] = matched['zip_match']
     
-    df_step3 = df_step2.dropna(subset=['city_clean', 'zip_clean']).copy()
-
-    # 6. CATEGORIZATION
-    l_type = df_step3['LICENSE TYPE'].str.upper().fillna('')
-    l_sub = df_step3['LICENSE SUBTYPE'].str.upper().fillna('')
-
-    df_step3['count_barber'] = ((l_type.str.contains('BARBER')) & (l_sub.isin(SUBTYPES['barbers']))).astype(int)
-    df_step3['count_cosmetologist'] = ((l_type.str.contains('COSMO')) & (l_sub.isin(SUBTYPES['cosmo']))).astype(int)
-    df_step3['count_salon'] = ((l_type.str.contains('COSMO|SALON|ESTAB')) & (l_sub.isin(SUBTYPES['places']))).astype(int)
-    df_step3['count_barbershop'] = ((l_type.str.contains('BARBER|SHOP')) & (l_sub.isin(SUBTYPES['places']))).astype(int)
-    df_step3['count_school'] = (l_sub.isin(SUBTYPES['schools'])).astype(int)
-    df_step3['count_booth'] = (l_type.str.contains('BOOTH')).astype(int)
-
-    # 7. AGGREGATION & GOLD STAGE
-    grouped = df_step3.groupby(['address_clean', 'city_clean', 'zip_clean']).agg({
-        'count_barber': 'sum', 'count_cosmetologist': 'sum', 'count_salon': 'sum',
-        'count_barbershop': 'sum', 'count_school': 'sum', 'count_booth': 'sum'
-    }).reset_index()
+        print(f"   ✅ Internal Matches Found: {updates.sum()}")
+
+        # 4. COMPTROLLER ENRICHMENT
+        df = enrich_from_comptroller(df, tax_download)
+        cancel.set()  # Done with the permit file (or never needed it: nothing was missing)
+
+        # 5. FINAL CLEANING
+        # One boolean mask over the rows; only the columns categorization and aggregation read are copied
+        has_address = df['address_clean'].notna().to_numpy()
+        address_loss = initial_count - int(has_address.sum())
+
+        if 'enriched_city' in df.columns:
+            city_clean = loc_parsed['city'].fillna(df['enriched_city'])
+            zip_clean = loc_parsed['zip'].fillna(df['enriched_zip'])
+        else:
+            city_clean = loc_parsed['city']
+            zip_clean = loc_parsed['zip']
+
+        keep = has_address & city_clean.notna().to_numpy() & zip_clean.notna().to_numpy()
+        df_step3 = df.loc[keep, ['address_clean', 'LICENSE TYPE', 'LICENSE SUBTYPE']].assign(city_clean=city_clean[keep], zip_clean=zip_clean[keep])
+
+        # 6. CATEGORIZATION
+        # Flags depend only on (type, subtype): the pair of category codes indexes a (types + 1) x (subtypes + 1) table
+        # directly, so rows need neither string hashing nor a factorize pass. Row/column 0 stands for a missing value.
+        type_cat = df_step3['LICENSE TYPE'].cat
+        sub_cat = df_step3['LICENSE SUBTYPE'].cat
+        # Types are uppercased and keyword-scanned once per distinct type, subtypes resolved once per distinct subtype
+        l_types = pd.Series(np.append('', type_cat.categories.str.upper()))
+        l_subs = pd.Series(np.append('', sub_cat.categories.str.upper()))
+        type_at, sub_at = np.divmod(np.arange(len(l_types) * len(l_subs)), len(l_subs))
+        has = {rx: l_types.str.contains(rx).to_numpy()[type_at]
+               for rx in (BARBER_TYPE_RE, COSMO_TYPE_RE, SALON_TYPE_RE, SHOP_TYPE_RE, BOOTH_TYPE_RE)}
+        group = l_subs.map(SUBTYPE_GROUPS).to_numpy()[sub_at]
+
+        kinds = pd.DataFrame({
+            'count_barber': has[BARBER_TYPE_RE] & (group == 'barbers'),
+            'count_cosmetologist': has[COSMO_TYPE_RE] & (group == 'cosmo'),
+            'count_salon': has[SALON_TYPE_RE] & (group == 'places'),
+            'count_barbershop': has[SHOP_TYPE_RE] & (group == 'places'),
+            'count_school': group == 'schools',
+            'count_booth': has[BOOTH_TYPE_RE]
+        }).astype('int8')
+        pair = (type_cat.codes.to_numpy(np.intp) + 1) * len(l_subs) + sub_cat.codes.to_numpy(np.intp) + 1
+        counted = kinds[COUNT_COLUMNS].to_numpy()[pair]
+
+        # 7. AGGREGATION & GOLD STAGE
+        # Rows matching no category add nothing to any count: drop them before grouping (replaces the total > 0 filter)
+        live = counted.any(axis=1)
+        grouped = sum_by(df_step3.loc[live, ['address_clean', 'city_clean', 'zip_clean']], counted[live], COUNT_COLUMNS)
     
-    grouped['state'] = 'TX'
-    grouped['total_licenses'] = grouped[['count_barber', 'count_cosmetologist', 'count_salon', 'count_barbershop', 'count_school', 'count_booth']].sum(axis=1)
-    grouped = grouped[grouped['total_licenses'] > 0].copy()
-    grouped['address_type'] = grouped.apply(determine_type, axis=1)
-
-    grouped.to_sql(GOLD_TABLE, engine, if_exists='replace', index=False,
-                   dtype={'address_clean': Text, 'city_clean': Text, 'total_licenses': Integer})
-
-    print(f"\n--- FINAL TEXAS AUDIT REPORT ---")
-    print(f"Total Raw Records:        {initial_count}")
-    print(f"Removed (Still No Addr):  {address_loss}")
-    print(f"Final Gold Locations:     {len(grouped)}")
-    print(f"-------------------------------\n")
+        grouped['state'] = 'TX'
+        grouped['total_licenses'] = grouped[COUNT_COLUMNS].to_numpy().sum(axis=1)  # One count per license row: a plain sum, no per-group distinct
+        grouped['address_type'] = determine_type(grouped)
+
+        # Gold COPY runs on its own connection while the raw dump may still be streaming
+        copy_frame(grouped, GOLD_TABLE, engine, dtype={'address_clean': Text, 'city_clean': Text, 'total_licenses': Integer,
+                                              **count_types(grouped, COUNT_COLUMNS)})  # Per-type counts as INT2 when they fit
+        if raw_load: raw_load.result()
+        raw_loader.shutdown()
+
+        print(f"\n--- FINAL TEXAS AUDIT REPORT ---")
+        print(f"Total Raw Records:        {initial_count}")
+        print(f"Skipped (Malformed):      {skipped_rows(all_tables)}")
+        print(f"Removed (Still No Addr):  {address_loss}")
+        print(f"Final Gold Locations:     {len(grouped)}")
+        print(f"-------------------------------\n")
+    finally:
+        # Also on sys.exit / errors before the enrichment: stop the download if still running, otherwise interpreter
+        # exit waits for the non-daemon prefetch thread to stream the whole file
+        cancel.set()
+        prefetch.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__": main()
@@ -1,4 +1,7 @@
 import os, sys, pandas as pd, requests, io, time, certifi, urllib.parse
+import pyarrow as pa, pyarrow.csv as pacsv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlalchemy import create_engine
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -17,28 +20,61 @@ FL_BOUNDS = {
 }
 
 try:
-    db_string_raw = os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://")
-    db_string = f"{db_string_raw}{'&' if '?' in db_string_raw else '?'}sslrootcert={certifi.where()}"
+    db_url = urllib.parse.urlsplit(os.environ['DB_CONNECTION_STRING'].replace("postgresql://", "cockroachdb://"))
+    db_query = dict(urllib.parse.parse_qsl(db_url.query)); db_query.setdefault('sslrootcert', certifi.where())  # Keep a caller-supplied CA
+    db_string = urllib.parse.urlunsplit(db_url._replace(query=urllib.parse.urlencode(db_query)))
     engine = create_engine(db_string)
 except KeyError:
     print("❌ ERROR: DB_CONNECTION_STRING missing."); sys.exit(1)
 
 MAPBOX_KEY = os.environ.get('MAPBOX_ACCESS_TOKEN')
 
-def get_gold_data(engine):
+# Shared HTTP session: worker threads reuse pooled keep-alive connections. Rate limits (429) and gateway 5xx
+# are retried with exponential backoff, honouring Retry-After; POST too, since a batch lookup has no side effects.
+# Read errors are not retried: a Census batch that timed out after 300 s falls through to Mapbox instead of re-uploading.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=MAX_MAPBOX_WORKERS, max_retries=Retry(
+    total=4, read=0, backoff_factor=2, status_forcelist=[429, 502, 503, 504], allowed_methods=None)))
+
+# Join keys are normalized server-side (CAST + strip float '.0' suffix) so pandas never re-scrubs them
+CENSUS_COLUMNS = ["id", "in", "match", "t", "addr", "coords", "line", "s"]  # Batch geocoder response layout
+JOIN_KEYS = ['address_clean', 'city_clean', 'state', 'zip_clean']
+KEY_SQL = ", ".join(f"regexp_replace(CAST({k} AS TEXT), '\\.0$', '') AS {k}" for k in JOIN_KEYS)
+
+def get_gold_data(conn):
     print("📥 DB: Fetching Florida Gold Data...")
-    query = """
-    SELECT address_clean, city_clean, state, zip_clean, total_licenses, 
-           count_barber, count_cosmetologist, count_salon, count_barbershop, 
+    gold = f"""
+    SELECT {KEY_SQL}, total_licenses,
+           count_barber, count_cosmetologist, count_salon, count_barbershop,
            count_owner, count_school, address_type
     FROM address_insights_fl_gold
     WHERE address_clean IS NOT NULL AND state = 'FL'
     """
-    return pd.read_sql(query, engine)
+    # LEFT JOIN geo_cache server-side: lat/lon come back NULL for addresses not geocoded yet;
+    # DISTINCT ON keeps one coordinate per key
+    query = f"""
+    SELECT DISTINCT ON ({", ".join(JOIN_KEYS)}) g.*, c.lat, c.lon FROM ({gold}) g
+    LEFT JOIN (SELECT {KEY_SQL}, lat, lon FROM geo_cache WHERE state = 'FL') c
+    USING ({", ".join(JOIN_KEYS)})
+    """
+    try:
+        return pd.read_sql(query, conn)
+    except:
+        conn.rollback()  # No geo_cache yet (the failed read also aborts the shared connection's transaction)
+        return pd.read_sql(gold, conn).assign(lat=float('nan'), lon=float('nan'))
 
-def get_geo_cache(engine):
-    try: return pd.read_sql("SELECT address_clean, city_clean, state, zip_clean, lat, lon FROM geo_cache", engine)
-    except: return pd.DataFrame(columns=['address_clean', 'city_clean', 'state', 'zip_clean', 'lat', 'lon'])
+def append_geo_cache(df, conn):
+    """
+    Appends geocoded rows to geo_cache through COPY FROM STDIN, fed by one vectorized to_csv
+    pass (no per-row tuples through pandas' to_sql insert path).
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    columns = ', '.join(f'"{c}"' for c in df.columns)
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(f'COPY geo_cache ({columns}) FROM STDIN WITH CSV', buf)
+    conn.connection.commit()  # Driver-level commit: the COPY ran on the DBAPI cursor, outside any SQLAlchemy transaction
 
 def geocode_census_chunk(chunk_df, batch_idx):
     csv_buffer = io.StringIO()
@@ -46,15 +82,22 @@ def geocode_census_chunk(chunk_df, batch_idx):
     csv_buffer.seek(0)
     files = {'addressFile': ('chunk.csv', csv_buffer, 'text/csv')}
     try:
-        r = requests.post(CENSUS_BATCH_URL, files=files, data={'benchmark': 'Public_AR_Current'}, timeout=300)
-        return batch_idx, r.text
+        r = session.post(CENSUS_BATCH_URL, files=files, data={'benchmark': 'Public_AR_Current'}, timeout=300)
+        return batch_idx, r.content  # Raw bytes: Arrow decodes them, no str copy of the whole response
     except: return batch_idx, None
 
-def parse_census_response(text):
+def parse_census_response(body):
     try:
-        df = pd.read_csv(io.StringIO(text), names=["id", "in", "match", "t", "addr", "coords", "line", "s"], on_bad_lines='skip')
+        # Arrow parse of the response bytes: only the three columns used are materialized, all as strings (no inference).
+        # No_Match/Tie lines are shorter than a full match record, so the parser skips them along with malformed rows.
+        table = pacsv.read_csv(io.BytesIO(body),
+                               read_options=pacsv.ReadOptions(column_names=CENSUS_COLUMNS, encoding='latin1'),
+                               parse_options=pacsv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+                               convert_options=pacsv.ConvertOptions(include_columns=['id', 'match', 'coords'],
+                                                                    column_types={c: pa.string() for c in CENSUS_COLUMNS}))
+        df = table.to_pandas()
         df = df[df['match'] == 'Match'].copy()
-        df[['lon', 'lat']] = df['coords'].astype(str).str.split(',', expand=True)
+        df[['lon', 'lat']] = df['coords'].str.split(',', n=1, expand=True)  # Always two columns, one vectorized pass
         return df[['id', 'lat', 'lon']].apply(pd.to_numeric, errors='coerce').dropna()
     except: return pd.DataFrame(columns=['id', 'lat', 'lon'])
 
@@ -62,7 +105,7 @@ def geocode_mapbox_single(row):
     query = urllib.parse.quote(f"{row['address_clean']}, {row['city_clean']}, FL {row['zip_clean']}")
     url = f"https://api.mapbox.com/geocoding/v5/mapbox.places/{query}.json?access_token={MAPBOX_KEY}&country=us&limit=1"
     try:
-        r = requests.get(url, timeout=10)
+        r = session.get(url, timeout=10)
         if r.status_code == 200 and r.json()['features']:
             c = r.json()['features'][0]['center']
             return row['id'], c[1], c[0]
@@ -70,21 +113,21 @@ def geocode_mapbox_single(row):
     return row['id'], None, None
 
 def main():
-    df_gold = get_gold_data(engine)
-    df_cache = get_geo_cache(engine)
-    
-    join_keys = ['address_clean', 'city_clean', 'state', 'zip_clean']
-    for col in join_keys:
-        df_gold[col] = df_gold[col].astype(str).str.replace(r'\.0$', '', regex=True)
-        df_cache[col] = df_cache[col].astype(str).str.replace(r'\.0$', '', regex=True)
+    conn = engine.connect()  # One pooled connection for every read and geo_cache write in this run
+    df_gold = get_gold_data(conn)
+    join_keys = JOIN_KEYS
 
-    merged = df_gold.merge(df_cache, on=join_keys, how='left', indicator=True)
-    to_geocode = merged[merged['_merge'] == 'left_only'].copy().drop_duplicates(subset=join_keys)
+    to_geocode = df_gold[df_gold['lat'].isnull()].copy()
     to_geocode['id'] = range(len(to_geocode))
     
     print(f"📊 STATUS: {len(df_gold)} FL Rows | {len(to_geocode)} New to Geocode")
     
     if not to_geocode.empty:
+        # Create geo_cache on first use, once per run: every batch below is a bare COPY.
+        # Same CREATE TABLE to_sql would emit, compiled against the run's connection (no second checkout, no reflection
+        # queries); IF NOT EXISTS makes it a no-op once the cache exists
+        ddl = pd.io.sql.get_schema(to_geocode[join_keys].head(0).assign(lat=0.0, lon=0.0), 'geo_cache', con=conn)
+        conn.exec_driver_sql(ddl.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1)); conn.commit()
         new_coords = []
         if MAPBOX_KEY and len(to_geocode) <= MAPBOX_ROW_LIMIT:
             print(f"⚡ MAPBOX MODE..."); workers = MAX_MAPBOX_WORKERS
@@ -100,7 +143,7 @@ def main():
                         res = {k: orig[k] for k in join_keys}; res['lat'] = lat; res['lon'] = lon
                         new_coords.append(res)
                         if len(new_coords) >= 500:
-                            pd.DataFrame(new_coords).to_sql('geo_cache', engine, if_exists='append', index=False)
+                            append_geo_cache(pd.DataFrame(new_coords), conn)
                             new_coords = []
         else:
             print(f"🐢 CENSUS MODE..."); chunks = []
@@ -114,13 +157,12 @@ def main():
                         m = parse_census_response(resp)
                         if not m.empty:
                             res = futures[f].drop(columns=['lat', 'lon'], errors='ignore').merge(m, on='id', how='inner')
-                            res[join_keys + ['lat', 'lon']].to_sql('geo_cache', engine, if_exists='append', index=False)
-        if new_coords: pd.DataFrame(new_coords).to_sql('geo_cache', engine, if_exists='append', index=False)
+                            append_geo_cache(res[join_keys + ['lat', 'lon']], conn)
+        if new_coords: append_geo_cache(pd.DataFrame(new_coords), conn)
 
-    final_cache = get_geo_cache(engine)
-    for col in join_keys: final_cache[col] = final_cache[col].astype(str).str.replace(r'\.0$', '', regex=True)
+    final_output = get_gold_data(conn)  # Re-read with this run's new coordinates; ungeocoded rows fail the bounds check
+    conn.close()
     
-    final_output = df_gold.merge(final_cache, on=join_keys, how='inner')
     final_output = final_output[
         (final_output['lat'] >= FL_BOUNDS['lat_min']) & (final_output['lat'] <= FL_BOUNDS['lat_max']) & 
         (final_output['lon'] >= FL_BOUNDS['lon_min']) & (final_output['lon'] <= FL_BOUNDS['lon_max'])
@@ -7,24 +7,31 @@ FILES = {
     'TX': 'Booksy_TX_Licenses.csv'
 }
 OUTPUT_FILE = 'Booksy_USA_Licenses.csv'
+CHUNK_SIZE = 100000  # Rows held in memory at a time while merging
 
 def main():
     print("🚀 STARTING: Merging State Data...")
-    dfs = []
+    found = []
     
     for state, file in FILES.items():
         if os.path.exists(file):
             print(f"   ... Loading {state} data from {file}")
-            df = pd.read_csv(file)
-            dfs.append(df)
+            found.append(file)
         else:
             print(f"   ⚠️ Warning: {file} not found. Skipping {state}.")
 
-    if dfs:
-        # Concatenate all dataframes and fill missing columns with 0
-        combined = pd.concat(dfs, ignore_index=True).fillna(0)
-        combined.to_csv(OUTPUT_FILE, index=False)
-        print(f"✅ SUCCESS: Combined file generated! ({len(combined)} rows)")
+    if found:
+        # Union of the state headers (concat's column order); each chunk is aligned to it and
+        # appended straight to the output, so no combined frame is ever built
+        columns = list(dict.fromkeys(c for file in found for c in pd.read_csv(file, nrows=0).columns))
+        total, header = 0, True
+        with open(OUTPUT_FILE, 'w', newline='') as out:
+            for file in found:
+                for chunk in pd.read_csv(file, chunksize=CHUNK_SIZE):
+                    # Missing columns are filled with 0
+                    chunk.reindex(columns=columns, fill_value=0).fillna(0).to_csv(out, index=False, header=header)
+                    total += len(chunk); header = False
+        print(f"✅ SUCCESS: Combined file generated! ({total} rows)")
     else:
         print("❌ ERROR: No input files found to merge.")
 
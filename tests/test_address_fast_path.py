@@ -0,0 +1,36 @@
+import itertools, pandas as pd
+from etl_common import fast_clean, clean_address_ai, STREET_SUFFIXES
+
+# Addresses where the two paths have disagreed (usaddress drops BLDG and CAMINO, reads lone and spelled-out directionals,
+# route prefixes and post-directionals by context)
+REGRESSIONS = ['3301 COLLEGE AVE BLDG 1', '10 N ST', '5 E WAY', '100 E ST', '55 W ST', '1 N E ST', '10 NE ST APT 2',
+               '123 US HWY', '123 STATE ROAD', '123 COUNTY ROAD N', '123 SW ST PAUL CT', '123 HWY SQ', '123 MAIN WAY RM 12',
+               '123 5TH PLACE FL 2', '77 HWY 6', '300 CIR', '123 MAIN HWY E', '123 MAIN HWY W', '55 OAK HWY NE STE 4',
+               '7 CAMINO REAL RD', '4500 SW CAMINO REAL CIR SW APT 4B', '123 EAST PKWY N', '4500 E WEST TRL NE', '123 SOUTH TRL S']
+
+NUMBERS = ['123', '12B']
+PRE = ['', 'N ', 'SW ']
+NAMES = ['MAIN', 'N', 'E', 'NE', '5TH', 'MARTIN LUTHER KING', 'COURT', 'ST PAUL', 'LOT', 'UNIT', 'HWY', 'HIGHWAY',
+         'US', 'STATE', 'COUNTY', 'FM', 'BROADWAY', 'SAN JACINTO', '100', 'A', 'OLD DIXIE']
+POST = ['', ' N', ' E']
+UNITS = ['', ' STE 100', ' APT 4B', ' UNIT 3', ' SUITE A', ' RM 12', ' FL 2', ' BLDG 1', ' STE 1-A']
+
+def sample():
+    combos = itertools.product(NUMBERS, PRE, NAMES, STREET_SUFFIXES.split('|'), POST, UNITS)
+    return pd.Series(REGRESSIONS + [f"{n} {p}{m} {s}{q}{u}" for n, p, m, s, q, u in combos])
+
+def test_fast_path_agrees_with_usaddress():
+    addresses = sample()
+    cleaned = fast_clean(addresses)
+    hits = cleaned.notna()
+    assert hits.sum() > len(addresses) // 20  # Post-directional / BLDG / RM / FL lines (most of the sample) go to usaddress
+    mismatches = [(a, c, clean_address_ai(a)) for a, c in zip(addresses[hits], cleaned[hits]) if c != clean_address_ai(a)]
+    assert not mismatches, mismatches[:20]
+
+def test_plain_addresses_take_the_fast_path():
+    plain = pd.Series(['123 MAIN ST', '12B N MARTIN LUTHER KING BLVD STE 100', '4500 SW 8TH ST APT 4B', '77 SAN JACINTO AVE'])
+    assert fast_clean(plain).tolist() == ['123 MAIN ST', '12B MARTIN LUTHER KING BLVD STE 100', '4500 8TH ST APT 4B', '77 SAN JACINTO AVE']
+
+def test_bldg_is_left_to_usaddress():
+    assert fast_clean(pd.Series(['3301 COLLEGE AVE BLDG 1'])).isna().all()
+    assert clean_address_ai('3301 COLLEGE AVE BLDG 1') == '3301 COLLEGE AVE'
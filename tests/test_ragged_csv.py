@@ -0,0 +1,9 @@
+import io
+from etl_common import read_ragged_csv, skipped_rows
+
+def test_short_rows_are_padded_and_long_rows_counted():
+    body = io.BytesIO(b'a,b,c\nd,e\n"f\nx",g,h,i\n"j\nk",\n,,\xe9\n')
+    table = read_ragged_csv(body, ['0', '1', '2'])
+    rows = sorted(zip(*table.to_pydict().values()), key=str)
+    assert rows == [('a', 'b', 'c'), ('d', 'e', None), ('j\nk', None, None), (None, None, '\xe9')]  # Latin1, '' -> null, padded
+    assert skipped_rows([table]) == 1